@@ -50,21 +50,52 @@ initial dd is parsed only from the first partition.
 """
 
 import uuid
-from typing import List, Optional
+from typing import Dict, List, Optional, TextIO, Tuple
 import argparse
 import glob
 import sys
 import os
 import re
 import io
+import json
+import time
+import tarfile
+import shutil
+import stat
 import datetime
 import textwrap
 import subprocess
 import logging
+import asyncio
+import gzip
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 
 VERBOSE = False
 
+# Seconds between progress updates while copying or extracting
+PROGRESS_INTERVAL = 0.5
+
+# Block size used to estimate the allocated size of the files
+CONTENT_BLOCK_SIZE = 4096
+
+# Estimated share of the partition used by the filesystem itself, for ext this
+# includes the 5% reserved for root
+FILESYSTEM_OVERHEAD = {"fat32": 0.02, "ext4": 0.1, "ext2": 0.07}
+
+# Bytes per inode in mkfs.ext2 and mkfs.ext4 defaults
+FILESYSTEM_INODE_RATIO = {"ext4": 16384, "ext2": 16384}
+
+# Size of the chunks read ahead in pipelined builds
+READAHEAD_CHUNK_SIZE = 1024 ** 2
+
+# Used in reproducible builds if SOURCE_DATE_EPOCH is not set, FAT can't store
+# earlier times than 1980-01-01
+DEFAULT_SOURCE_DATE_EPOCH = 315532800
+
 
 def _set_verbose(val: bool):
     global VERBOSE
@@ -76,6 +107,37 @@ def _is_verbose():
     return VERBOSE
 
 
+class CommandRunner:
+    """
+    Runs the external commands
+
+    All commands go through the runner set with `_set_runner`, so that tests
+    can replace it with a fake one.
+    """
+
+    def run(self, cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(cmd, **kwargs)
+
+    def popen(self, cmd: List[str], **kwargs) -> subprocess.Popen:
+        return subprocess.Popen(cmd, **kwargs)
+
+    def which(self, cmd: str) -> Optional[str]:
+        return shutil.which(cmd)
+
+
+RUNNER = CommandRunner()
+
+
+def _set_runner(runner: CommandRunner):
+    global RUNNER
+    RUNNER = runner
+
+
+def _get_runner() -> CommandRunner:
+    global RUNNER
+    return RUNNER
+
+
 def print_error(err: str):
     CRED = "\033[91m"
     CEND = "\033[0m"
@@ -122,11 +184,86 @@ class PartitionParseException(Exception):
         self.filename = filename
 
 
+class PreflightException(Exception):
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+
+
+class StagingSpaceException(Exception):
+    def __init__(self, staging_dir: str, needed: int, available: int):
+        self.staging_dir = staging_dir
+        self.needed = needed
+        self.available = available
+
+
 class PartfsMountInUseException(Exception):
     def __init__(self, mountdir: str):
         self.mountdir = mountdir
 
 
+class ProgressReporter:
+    """
+    Reports copy and extract progress of partitions
+
+    Draws a progress bar on the terminal if `bar` is set, and writes line
+    delimited JSON progress events to `json_stream` if it's given.
+    """
+
+    def __init__(self, bar: bool = False, json_stream: Optional[TextIO] = None):
+        self.bar = bar
+        self.json_stream = json_stream
+
+    def update(
+        self, name: str, done: int, total: int, elapsed: float, finished=False
+    ):
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else None
+        if self.json_stream:
+            event = {
+                "event": "done" if finished else "progress",
+                "partition": name,
+                "bytes_done": done,
+                "bytes_total": total,
+                "elapsed": round(elapsed, 3),
+                "mb_per_s": round(rate / 1000 ** 2, 3),
+                "eta": None if eta is None else round(eta, 3),
+            }
+            self.json_stream.write(json.dumps(event) + "\n")
+            self.json_stream.flush()
+        if self.bar:
+            width = 30
+            ratio = done / total if total > 0 else 1.0
+            filled = int(width * ratio)
+            eta_str = "--:--" if eta is None else "{:02d}:{:02d}".format(
+                *divmod(int(eta), 60)
+            )
+            line = "{} [{}{}] {:3d}% {:.1f} MB/s ETA {}".format(
+                name,
+                "#" * filled,
+                "." * (width - filled),
+                int(ratio * 100),
+                rate / 1000 ** 2,
+                eta_str,
+            )
+            print("\r" + line, end="\n" if finished else "", flush=True)
+
+
+class Reproducible:
+    """
+    Settings for reproducible builds
+
+    Filesystem UUIDs, volume ids and GPT GUIDs are derived from the seed, and
+    timestamps of the copied files are clamped to the epoch.
+    """
+
+    def __init__(self, epoch: int, seed: str):
+        self.epoch = epoch
+        self.seed = seed
+
+    def get_uuid(self, *names: str) -> uuid.UUID:
+        return uuid.uuid5(uuid.NAMESPACE_URL, "/".join((self.seed,) + names))
+
+
 class Partfs:
     """
     Mounts diskimage partitions as FUSE mounts
@@ -145,7 +282,7 @@ class Partfs:
             os.mkdir(self.mountdir)
 
         try:
-            subprocess.run(
+            _get_runner().run(
                 ["partfs", "-o", f"dev={self.diskimage}", self.mountdir], check=True
             )
         except subprocess.CalledProcessError as err:
@@ -156,7 +293,7 @@ class Partfs:
 
     def __exit__(self, type, value, traceback):
         try:
-            subprocess.run(["fusermount", "-u", self.mountdir], check=True)
+            _get_runner().run(["fusermount", "-u", self.mountdir], check=True)
         except subprocess.CalledProcessError as err:
             print_error("Unmount failed.")
             raise err
@@ -182,19 +319,23 @@ class Losetup:
         self.device = None
 
         # Get or create losetup device
-        losetup_f = subprocess.run(["losetup", "-f"], text=True, capture_output=True)
+        losetup_f = _get_runner().run(
+            ["losetup", "-f"], text=True, capture_output=True
+        )
         if losetup_f.returncode == 0:
             self.device = losetup_f.stdout.strip()
         elif losetup_f.stderr.startswith(
             "losetup: cannot find an unused loop device: No such device"
         ):
-            subprocess.run(["mknod", "/dev/loop0", "b", "7", "0"], check=True)
+            _get_runner().run(["mknod", "/dev/loop0", "b", "7", "0"], check=True)
             self.device = "/dev/loop0"
         else:
             losetup_f.check_returncode()
 
         try:
-            subprocess.run(["losetup", "-P", self.device, self.diskimage], check=True)
+            _get_runner().run(
+                ["losetup", "-P", self.device, self.diskimage], check=True
+            )
         except subprocess.CalledProcessError as err:
             print_error(f"Losetup {self.device} failed.")
             raise err
@@ -204,7 +345,7 @@ class Losetup:
     def __exit__(self, type, value, traceback):
         if self.device:
             try:
-                subprocess.run(["losetup", "-d", self.device], check=True)
+                _get_runner().run(["losetup", "-d", self.device], check=True)
             except subprocess.CalledProcessError as err:
                 print_error(f"Losetup failed to free device: {self.device}")
                 raise err
@@ -225,7 +366,7 @@ class Mount:
             os.mkdir(self.target)
 
         try:
-            subprocess.run(["mount", self.source, self.target], check=True)
+            _get_runner().run(["mount", self.source, self.target], check=True)
         except subprocess.CalledProcessError as err:
             print_error("Mount failed.")
             raise err
@@ -234,7 +375,7 @@ class Mount:
 
     def __exit__(self, type, value, traceback):
         try:
-            subprocess.run(["umount", self.target], check=True)
+            _get_runner().run(["umount", self.target], check=True)
         except subprocess.CalledProcessError as err:
             print_error(f"Unmount failed to free target: {self.target}")
             raise err
@@ -242,35 +383,253 @@ class Mount:
         print_ok(f"Mount {self.target} freed.")
 
 
+class ContentStats:
+    """
+    Totals of the files to be copied to a partition
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.allocated = 0
+        self.inodes = 0
+        self.hardlinks = 0
+
+    def add(self, size: int, is_dir: bool = False):
+        self.inodes += 1
+        self.size += size
+        blocks = max(1, -(-size // CONTENT_BLOCK_SIZE)) if size or is_dir else 0
+        self.allocated += blocks * CONTENT_BLOCK_SIZE
+
+
+class Staging:
+    """
+    Builds the diskimage in a staging directory, e.g. in tmpfs
+
+    On success the image is published to the final location with a sparse
+    copy and an atomic rename. On failure the staged image is removed, so
+    partial image files are never left behind.
+    """
+
+    def __init__(
+        self, diskimage: str, staging_dir: str, needed: int, overwrite: bool = False
+    ):
+        self.diskimage = diskimage
+        self.staging_dir = staging_dir
+        self.needed = needed
+        self.overwrite = overwrite
+        self.stagedimage = os.path.join(
+            staging_dir,
+            "{}.staging{}".format(os.path.basename(diskimage), uuid.uuid4().hex),
+        )
+
+    def __enter__(self):
+        if os.path.exists(self.diskimage) and not self.overwrite:
+            raise ImageFileExistsException(self.diskimage)
+        if not os.path.isdir(self.staging_dir):
+            os.mkdir(self.staging_dir)
+
+        # Files in tmpfs are backed by memory and swap
+        available = shutil.disk_usage(self.staging_dir).free
+        if _get_fs_type(self.staging_dir) == "tmpfs":
+            available = min(available, _get_available_memory())
+        if self.needed > available:
+            raise StagingSpaceException(self.staging_dir, self.needed, available)
+        print_ok(f"Staging {self.stagedimage} created.")
+        return self.stagedimage
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            if os.path.exists(self.stagedimage):
+                os.remove(self.stagedimage)
+            print_ok(f"Staging {self.stagedimage} removed.")
+            return
+
+        # Copy next to the final image, so that the rename is atomic
+        final_dir = _get_dirname(self.diskimage)
+        if os.stat(self.staging_dir).st_dev != os.stat(final_dir).st_dev:
+            publishing = os.path.join(
+                final_dir,
+                ".{}.publishing{}".format(
+                    os.path.basename(self.diskimage), uuid.uuid4().hex
+                ),
+            )
+            print_notice(f"Copying staged image to '{publishing}'...")
+            try:
+                _get_runner().run(
+                    ["cp", "--sparse=always", self.stagedimage, publishing],
+                    check=True,
+                )
+            except subprocess.CalledProcessError as err:
+                print_error("Copying staged image failed.")
+                if os.path.exists(publishing):
+                    os.remove(publishing)
+                raise err
+            finally:
+                os.remove(self.stagedimage)
+        else:
+            publishing = self.stagedimage
+        os.replace(publishing, self.diskimage)
+        print_ok(f"Staging {self.stagedimage} published to {self.diskimage}.")
+
+
+class ArchiveReader:
+    """
+    Reads and decompresses a .tar or .tar.gz file ahead into a bounded buffer
+
+    `run` is executed in its own thread, and the decompressed chunks are
+    consumed by iterating the reader.
+    """
+
+    def __init__(self, filename: str, chunks: int):
+        self.filename = filename
+        self._queue = queue.Queue(maxsize=max(1, chunks))  # type: queue.Queue
+        self._cancelled = threading.Event()
+
+    def run(self):
+        opener = gzip.open if self.filename.endswith(".gz") else open
+        try:
+            with opener(self.filename, "rb") as f:
+                while True:
+                    chunk = f.read(READAHEAD_CHUNK_SIZE)
+                    if not self._put(chunk) or not chunk:
+                        break
+        except Exception as err:
+            self._put(err)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _put(self, item) -> bool:
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                return
+            yield item
+
+
 class Partition:
-    def __init__(self, filename: str, parted: str, fstype: str = ""):
+    def __init__(
+        self,
+        filename: str,
+        parted: str,
+        fstype: str = "",
+        start: str = "",
+        end: str = "",
+    ):
         self.filename = filename
         self.parted = parted
         self.fstype = fstype
+        self.start = start
+        self.end = end
+        self._content_stats = None  # type: Optional[ContentStats]
 
     def is_mountable(self):
         if self.fstype == "linux-swap":
             return False
         return True
 
-    def try_copy_to(self, to_dir: str):
+    def get_content_stats(self) -> ContentStats:
+        """
+        Totals of the files, read from the tar headers or by scanning the directory
+        """
+        if self._content_stats is not None:
+            return self._content_stats
+
+        stats = ContentStats()
+        if os.path.isdir(self.filename):
+            seen = set()
+            for dirpath, dirnames, filenames in os.walk(self.filename):
+                for fname in dirnames + filenames:
+                    st = os.lstat(os.path.join(dirpath, fname))
+                    if stat.S_ISDIR(st.st_mode):
+                        stats.add(0, is_dir=True)
+                    elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in seen:
+                        stats.hardlinks += 1
+                    else:
+                        seen.add((st.st_dev, st.st_ino))
+                        stats.add(st.st_size if stat.S_ISREG(st.st_mode) else 0)
+        elif self.is_archive():
+            try:
+                with tarfile.open(self.filename, "r|*") as tar:
+                    for member in tar:
+                        if member.islnk():
+                            stats.hardlinks += 1
+                        else:
+                            stats.add(member.size, is_dir=member.isdir())
+            except tarfile.ReadError:
+                # Empty tar files are fine for tar, but not for tarfile
+                pass
+        self._content_stats = stats
+        return stats
+
+    def get_content_size(self) -> int:
+        """
+        Total size of the files in bytes
+        """
+        return self.get_content_stats().size
+
+    def try_copy_to(
+        self,
+        to_dir: str,
+        progress: Optional[ProgressReporter] = None,
+        reproducible: Optional[Reproducible] = None,
+        source: Optional[ArchiveReader] = None,
+    ):
         if os.path.isdir(self.filename):
             # Directory
+            if reproducible:
+                # Copy through tar to get the files in a fixed order
+                parent, base = os.path.split(os.path.abspath(self.filename))
+                cmds = [
+                    ["tar", "--sort=name", "-cf", "-", "-C", parent, base],
+                    ["tar", "--same-owner", "-xf", "-", "-C", to_dir],
+                ]
+            else:
+                cmds = [["cp", "-rp", self.filename, to_dir]]
             print_notice(f"Copy -rp files from '{self.filename}' to '{to_dir}'...")
             try:
-                subprocess.run(["cp", "-rp", self.filename, to_dir], check=True)
+                self._try_run_with_progress(cmds, to_dir, progress)
             except subprocess.CalledProcessError as err:
                 print_error("Copying files failed.")
                 raise err
             print_ok(f"Copying from '{self.filename}' succeeded.")
 
+        elif source is not None:
+            # .tar or .tar.gz files read ahead
+            print_notice(
+                f"Untar read ahead files from '{self.filename}' to '{to_dir}'..."
+            )
+            try:
+                self._try_run_with_progress(
+                    [["tar", "--same-owner", "-xf", "-", "-C", to_dir]],
+                    to_dir,
+                    progress,
+                    source,
+                )
+            except subprocess.CalledProcessError as err:
+                print_error("Untar failed.")
+                raise err
+            print_ok(f"Untar from '{self.filename}' succeeded.")
+
         elif self.filename.endswith(".tar"):
             # .tar files
             print_notice(f"Untar files from '{self.filename}' to '{to_dir}'...")
             try:
-                subprocess.run(
-                    ["tar", "--same-owner", "-xf", self.filename, "-C", to_dir],
-                    check=True,
+                self._try_run_with_progress(
+                    [["tar", "--same-owner", "-xf", self.filename, "-C", to_dir]],
+                    to_dir,
+                    progress,
                 )
             except subprocess.CalledProcessError as err:
                 print_error("Untar failed.")
@@ -281,15 +640,99 @@ class Partition:
             # .tar.gz files
             print_notice(f"Untar gzip files from '{self.filename}' to '{to_dir}'...")
             try:
-                subprocess.run(
-                    ["tar", "--same-owner", "-xzf", self.filename, "-C", to_dir],
-                    check=True,
+                self._try_run_with_progress(
+                    [["tar", "--same-owner", "-xzf", self.filename, "-C", to_dir]],
+                    to_dir,
+                    progress,
                 )
             except subprocess.CalledProcessError as err:
                 print_error("Untar failed.")
                 raise err
             print_ok(f"Untar from '{self.filename}' succeeded.")
 
+        if reproducible:
+            _clamp_mtimes(to_dir, reproducible.epoch)
+
+    def _try_run_with_progress(
+        self,
+        cmds: List[List[str]],
+        to_dir: str,
+        progress: Optional[ProgressReporter],
+        source: Optional[ArchiveReader] = None,
+    ):
+        """
+        Runs the copy commands as a pipeline, reporting the progress while it runs
+
+        If the source is given, it's written to the stdin of the first command.
+
+        Bytes written are measured from the growth of the used space in the
+        target filesystem, so they are only approximate.
+        """
+        if not progress and not source and len(cmds) == 1:
+            _get_runner().run(cmds[0], check=True)
+            return
+
+        name = os.path.basename(self.filename)
+        total = self.get_content_size() if progress else 0
+        used_at_start = _get_used_bytes(to_dir) if progress else 0
+        started = time.monotonic()
+
+        def report(finished=False):
+            if not progress:
+                return
+            done = total
+            if not finished:
+                done = max(0, min(_get_used_bytes(to_dir) - used_at_start, total))
+            progress.update(name, done, total, time.monotonic() - started, finished)
+
+        procs = []
+        try:
+            for i, cmd in enumerate(cmds):
+                stdin = procs[-1].stdout if procs else None
+                if not procs and source is not None:
+                    stdin = subprocess.PIPE
+                proc = _get_runner().popen(
+                    cmd,
+                    stdin=stdin,
+                    stdout=subprocess.PIPE if i < len(cmds) - 1 else None,
+                )
+                if procs:
+                    # Allows the previous command to receive SIGPIPE
+                    procs[-1].stdout.close()
+                procs.append(proc)
+            if source is not None:
+                reported = time.monotonic()
+                try:
+                    for chunk in source:
+                        procs[0].stdin.write(chunk)
+                        if time.monotonic() - reported > PROGRESS_INTERVAL:
+                            report()
+                            reported = time.monotonic()
+                    procs[0].stdin.close()
+                except BrokenPipeError:
+                    # Command exited early, the return code tells why
+                    pass
+            while True:
+                try:
+                    procs[-1].wait(timeout=PROGRESS_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    report()
+            for proc in procs:
+                proc.wait()
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+        for cmd, proc in zip(cmds, procs):
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        report(True)
+
+    def is_archive(self):
+        return self.filename.endswith(".tar") or self.filename.endswith(".tar.gz")
+
 
 class PartitionCollection:
     def __init__(self, partitions: List[Partition]):
@@ -323,6 +766,47 @@ class PartitionCollection:
     def get_fstypes(self):
         return list(map(lambda k: k.fstype, self._partitions))
 
+    def get_partition_sizes(self, total_size: int) -> List[Optional[int]]:
+        """
+        Tries to get the size of each partition in bytes, None if unknown
+        """
+        sector_units = any("unit s " in p.parted for p in self._partitions)
+        sizes = []
+        for partition in self._partitions:
+            try:
+                start = _parse_position(partition.start, total_size, sector_units)
+                end = _parse_position(partition.end, total_size, sector_units)
+                sizes.append(end - start)
+            except PartitionSizeParseException:
+                sizes.append(None)
+        return sizes
+
+    def get_estimated_usage(self, total_size: int) -> int:
+        """
+        Estimates how many bytes the sparse image file uses when it's done
+        """
+        usage = 0
+        sizes = self.get_partition_sizes(total_size)
+        for partition, size in zip(self._partitions, sizes):
+            if partition.is_mountable():
+                usage += partition.get_content_stats().allocated
+            overhead = FILESYSTEM_OVERHEAD.get(partition.fstype, 0)
+            usage += int((size or 0) * overhead)
+        return usage
+
+    def get_table_type(self) -> Optional[str]:
+        m = re.search(r"mklabel (?P<table_type>[^ ]+)", self._partitions[0].parted)
+        if m:
+            return m.group("table_type")
+        return None
+
+    def get_reproducible(self, epoch: int) -> Reproducible:
+        """
+        Reproducible settings seeded from the partition file names
+        """
+        names = [os.path.basename(p.filename) for p in self._partitions]
+        return Reproducible(epoch, "/".join(names))
+
     def __iter__(self):
         return iter(self._partitions)
 
@@ -349,8 +833,19 @@ class Imagefile:
     def make_empty(self, total_size: int, overwrite: bool = False):
         _try_dd(self.filename, total_size, overwrite)
 
-    def partition(self, partitions: PartitionCollection):
+    def partition(
+        self,
+        partitions: PartitionCollection,
+        reproducible: Optional[Reproducible] = None,
+    ):
         _try_parted(self.filename, partitions.get_parted())
+        if reproducible:
+            _try_set_disk_ids(
+                self.filename,
+                partitions.get_table_type(),
+                len(partitions.get_parted()),
+                reproducible,
+            )
 
     def mount(
         self,
@@ -395,23 +890,223 @@ def try_create_image(
     use_partfs=False,
     partfs_mount_dir="/mnt/_temp_partfs",
     mount_root_dir="/mnt/_temp_fs",
+    progress: Optional[ProgressReporter] = None,
+    reproducible_epoch: Optional[int] = None,
+    preflight=True,
+    staging_dir: Optional[str] = None,
+    pipelined=False,
+    readahead=64 * 1024 ** 2,
 ):
     print(f"Partitions directory: {rootdir}")
     print(f"Image file to create: {imagefilename}")
     partitions = PartitionCollection.from_directory(rootdir)
     total_size = partitions.get_total_size()
-    imagefile = Imagefile(imagefilename)
-    imagefile.make_empty(total_size, overwrite)
-    imagefile.partition(partitions)
-
-    with imagefile.mount(
-        partitions, use_partfs=use_partfs, partfs_mount_dir=partfs_mount_dir
-    ) as partition_dirs:
-        for partition, partition_dir in partition_dirs:
-            _try_mkfs(partition_dir, partition.fstype)
+    reproducible = None
+    if reproducible_epoch is not None:
+        reproducible = partitions.get_reproducible(reproducible_epoch)
+    if preflight:
+        try_preflight(
+            partitions,
+            imagefilename,
+            total_size,
+            use_partfs=use_partfs,
+            reproducible=reproducible is not None,
+        )
+
+    with ExitStack() as cm:
+        if staging_dir:
+            imagefilename = cm.enter_context(
+                Staging(
+                    imagefilename,
+                    staging_dir,
+                    partitions.get_estimated_usage(total_size),
+                    overwrite,
+                )
+            )
+        imagefile = Imagefile(imagefilename)
+        imagefile.make_empty(total_size, overwrite)
+        imagefile.partition(partitions, reproducible)
+
+        with imagefile.mount(
+            partitions, use_partfs=use_partfs, partfs_mount_dir=partfs_mount_dir
+        ) as partition_dirs:
+            if pipelined:
+                _try_fill_partitions_pipelined(
+                    list(partition_dirs),
+                    mount_root_dir,
+                    progress,
+                    reproducible,
+                    readahead,
+                )
+            else:
+                for i, (partition, partition_dir) in enumerate(partition_dirs):
+                    _try_mkfs(partition_dir, partition.fstype, reproducible, str(i + 1))
+                    if partition.is_mountable():
+                        with Mount(partition_dir, mount_root_dir) as mntdir:
+                            partition.try_copy_to(mntdir, progress, reproducible)
+
+
+def _try_fill_partitions_pipelined(
+    partition_dirs: List[Tuple[Partition, str]],
+    mount_root_dir: str,
+    progress: Optional[ProgressReporter],
+    reproducible: Optional[Reproducible],
+    readahead: int,
+):
+    """
+    Makes filesystems and copies files with the independent work overlapped
+
+    All archives are read and decompressed ahead into bounded buffers right
+    away, and all filesystems are made in parallel. Partitions are then
+    written one at a time from the buffers.
+    """
+    # Readers block when their buffers are full, so each needs its own thread
+    workers = 2 * len(partition_dirs) + 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        asyncio.run(
+            _fill_partitions_pipelined(
+                executor,
+                partition_dirs,
+                mount_root_dir,
+                progress,
+                reproducible,
+                readahead,
+            )
+        )
+
+
+async def _fill_partitions_pipelined(
+    executor: ThreadPoolExecutor,
+    partition_dirs: List[Tuple[Partition, str]],
+    mount_root_dir: str,
+    progress: Optional[ProgressReporter],
+    reproducible: Optional[Reproducible],
+    readahead: int,
+):
+    loop = asyncio.get_event_loop()
+    readers = {}  # type: Dict[int, ArchiveReader]
+    reading = []
+    for i, (partition, _) in enumerate(partition_dirs):
+        if partition.is_mountable() and partition.is_archive():
+            readers[i] = ArchiveReader(
+                partition.filename, readahead // READAHEAD_CHUNK_SIZE
+            )
+            reading.append(loop.run_in_executor(executor, readers[i].run))
+
+    def copy(i: int, partition: Partition, partition_dir: str):
+        with Mount(partition_dir, mount_root_dir) as mntdir:
+            partition.try_copy_to(mntdir, progress, reproducible, readers.get(i))
+
+    try:
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor,
+                    _try_mkfs,
+                    partition_dir,
+                    partition.fstype,
+                    reproducible,
+                    str(i + 1),
+                )
+                for i, (partition, partition_dir) in enumerate(partition_dirs)
+            ]
+        )
+        for i, (partition, partition_dir) in enumerate(partition_dirs):
             if partition.is_mountable():
-                with Mount(partition_dir, mount_root_dir) as mntdir:
-                    partition.try_copy_to(mntdir)
+                await loop.run_in_executor(executor, copy, i, partition, partition_dir)
+    finally:
+        for reader in readers.values():
+            reader.cancel()
+        await asyncio.gather(*reading)
+
+
+def try_preflight(
+    partitions: PartitionCollection,
+    imagefilename: str,
+    total_size: int,
+    use_partfs=False,
+    reproducible=False,
+):
+    """
+    Checks that the files fit the partitions and that the tools are present
+
+    Runs before anything is allocated, so that a build which is bound to fail
+    fails in seconds. Sizes are estimates, the check errs on the permissive side.
+    """
+    print_notice("Executing pre-flight checks...")
+    errors = []
+
+    # Tools
+    fstypes = partitions.get_fstypes()
+    tools = ["dd", "parted", "cp", "tar", "mount", "umount"]
+    tools += ["partfs", "fusermount"] if use_partfs else ["losetup"]
+    tools += ["sfdisk"] if reproducible else []
+    mkfs_tools = {
+        "fat32": "mkfs.fat",
+        "ext4": "mkfs.ext4",
+        "ext2": "mkfs.ext2",
+        "linux-swap": "mkswap",
+    }
+    tools += [mkfs_tools[fstype] for fstype in fstypes if fstype in mkfs_tools]
+    for tool in sorted(set(tools)):
+        if _get_runner().which(tool) is None:
+            errors.append(f"Required command '{tool}' not found.")
+
+    # Partitions
+    sizes = partitions.get_partition_sizes(total_size)
+    for partition, size in zip(partitions, sizes):
+        name = os.path.basename(partition.filename)
+        if partition.fstype not in mkfs_tools:
+            errors.append(f"{name}: Unknown filesystem '{partition.fstype}'.")
+            continue
+        stats = partition.get_content_stats()
+        report = (
+            f"{name}: {stats.allocated} bytes, {stats.inodes} inodes, {stats.hardlinks} hardlinks"
+        )
+        if size is None:
+            print_notice(f"{report}, partition size unknown")
+            continue
+        if size <= 0:
+            errors.append(f"{name}: Partition has no space ({size} bytes).")
+            continue
+        if not partition.is_mountable():
+            print_notice(f"{report}, not mountable")
+            continue
+
+        usable = int(size * (1 - FILESYSTEM_OVERHEAD.get(partition.fstype, 0)))
+        report += f" of {usable} usable bytes"
+        if stats.allocated > usable:
+            errors.append(
+                f"{name}: Files need {stats.allocated} bytes, but only {usable} bytes usable."
+            )
+        if partition.fstype in FILESYSTEM_INODE_RATIO:
+            max_inodes = size // FILESYSTEM_INODE_RATIO[partition.fstype]
+            report += f", {max_inodes} inodes"
+            if stats.inodes > max_inodes:
+                errors.append(
+                    f"{name}: Files need {stats.inodes} inodes, but only {max_inodes} available."
+                )
+        if partition.fstype == "fat32" and stats.hardlinks:
+            errors.append(
+                f"{name}: FAT32 does not support hardlinks ({stats.hardlinks} found)."
+            )
+        print_notice(report)
+
+    # Image file, it's sparse so only the files and metadata need to fit
+    imagedir = _get_dirname(imagefilename)
+    if os.path.isdir(imagedir):
+        needed = partitions.get_estimated_usage(total_size)
+        free = shutil.disk_usage(imagedir).free
+        if needed > free:
+            errors.append(
+                f"Image needs about {needed} bytes, but only {free} bytes free in '{imagedir}'."
+            )
+    else:
+        errors.append(f"Directory '{imagedir}' for the image file does not exist.")
+
+    if errors:
+        raise PreflightException(errors)
+    print_ok("Pre-flight checks succeeded.")
 
 
 def parse_cli_arguments():
@@ -436,6 +1131,44 @@ def parse_cli_arguments():
         help="Uses FUSE based partfs instead of losetup for mounting partitions, defaults to true in docker environment",
         action="store_true",
     )
+    parser.add_argument(
+        "--progress",
+        help="Shows a progress bar while copying files, defaults to auto (when running interactively)",
+        choices=["auto", "bar", "none"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--progress-json",
+        help="Writes line delimited JSON progress events to a file, use - for stdout",
+        action="store",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--staging-dir",
+        help="Builds the image in this directory (e.g. tmpfs) and moves it to the final location when done",
+        action="store",
+    )
+    parser.add_argument(
+        "--pipelined",
+        help="Makes filesystems in parallel and reads archives ahead while earlier partitions are written",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--readahead",
+        help="Maximum size of each read ahead buffer in pipelined builds, defaults to 64MiB",
+        action="store",
+        default="64MiB",
+    )
+    parser.add_argument(
+        "--skip-preflight",
+        help="Skips checking that the files fit the partitions before creating the image",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--reproducible",
+        help="Creates bit-identical images from identical partitions, file times are clamped to SOURCE_DATE_EPOCH (defaults to 1980-01-01)",
+        action="store_true",
+    )
     parser.add_argument("-v", "--verbose", action="store_true")
 
     return (parser, parser.parse_args())
@@ -447,9 +1180,24 @@ def main():
 
     _set_verbose(args.verbose)
 
-    # TODO: Something fun?
-    # if sys.stdout.isatty():
-    #     print_notice("You are running interactively")
+    # Progress reporting
+    progress_bar = args.progress == "bar" or (
+        args.progress == "auto" and sys.stdout.isatty()
+    )
+    progress_json = None
+    if args.progress_json == "-":
+        progress_json = sys.stdout
+    elif args.progress_json:
+        progress_json = open(args.progress_json, "w")
+    progress = None
+    if progress_bar or progress_json:
+        progress = ProgressReporter(bar=progress_bar, json_stream=progress_json)
+
+    reproducible_epoch = None
+    if args.reproducible:
+        reproducible_epoch = int(
+            os.environ.get("SOURCE_DATE_EPOCH", DEFAULT_SOURCE_DATE_EPOCH)
+        )
 
     # Fail if partitions directory does not exist
     if not os.path.isdir(args.partitions_dir):
@@ -464,11 +1212,26 @@ def main():
             overwrite=args.force,
             use_partfs=args.use_partfs,
             partfs_mount_dir="/mnt/_tmp_partfs{}".format(uuid.uuid4().hex),
+            progress=progress,
+            reproducible_epoch=reproducible_epoch,
+            preflight=not args.skip_preflight,
+            staging_dir=args.staging_dir,
+            pipelined=args.pipelined,
+            readahead=_parse_size(args.readahead),
         )
     except ImageFileExistsException as err:
         print_error(
             f"Image file '{err.imagefile}' already exists, use `-f` to overwrite"
         )
+    except StagingSpaceException as err:
+        print_error(
+            f"Staging directory '{err.staging_dir}' has {err.available} bytes available, but the image needs about {err.needed} bytes"
+        )
+        exit(1)
+    except PreflightException as err:
+        for error in err.errors:
+            print_error(error)
+        exit(1)
     except PartitionsNotFoundException:
         print_error(f"Directory '{args.partitions_dir}' does not contain partitions.")
         exit(1)
@@ -513,6 +1276,20 @@ def _parse_size(size: str):
     raise PartitionSizeParseException()
 
 
+def _parse_position(position: str, total_size: int, sector_units=False):
+    """
+    Parse partition start or end position for parted
+    """
+    if position.endswith("%"):
+        try:
+            return int(total_size * float(position[:-1]) / 100)
+        except ValueError:
+            raise PartitionSizeParseException(position)
+    if sector_units and re.match(r"^\d+$", position):
+        return int(position) * 512
+    return _parse_size(position)
+
+
 def _try_get_partitions_long_format(files: List[str]) -> List[Partition]:
     """
     Tries to get partitions in long format:
@@ -540,9 +1317,11 @@ def _try_get_partitions_long_format(files: List[str]) -> List[Partition]:
             if not m:
                 raise PartitionParseException(fname)
             fstype = m.group("fstype")
+            start = m.group("partition_start")
+            end = m.group("partition_end")
 
             # Add a partition
-            partitions.append(Partition(fname, parted, fstype))
+            partitions.append(Partition(fname, parted, fstype, start, end))
     return partitions
 
 
@@ -587,10 +1366,56 @@ def _try_get_partitions_short_format(files: List[str]) -> List[Partition]:
                 parted = f"unit s mklabel {table_type} mkpart primary {fstype} {partition_start} {partition_end} set 1 boot on"
             else:
                 parted = f"mkpart primary {fstype} {partition_start} {partition_end}"
-            partitions.append(Partition(fname, parted, fstype))
+            partitions.append(
+                Partition(fname, parted, fstype, partition_start, partition_end)
+            )
     return partitions
 
 
+def _get_used_bytes(dirname: str) -> int:
+    stat = os.statvfs(dirname)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def _get_dirname(filename: str) -> str:
+    return os.path.dirname(os.path.abspath(filename))
+
+
+def _get_fs_type(dirname: str) -> Optional[str]:
+    """
+    Filesystem type of the mount containing the directory, from /proc/mounts
+    """
+    dirname = os.path.realpath(dirname)
+    fs_type = None
+    longest = -1
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                mountpoint = fields[1].replace("\\040", " ")
+                if len(mountpoint) > longest and (
+                    dirname == mountpoint
+                    or dirname.startswith(mountpoint.rstrip("/") + "/")
+                ):
+                    fs_type = fields[2]
+                    longest = len(mountpoint)
+    except OSError:
+        pass
+    return fs_type
+
+
+def _get_available_memory() -> int:
+    """
+    Available memory and free swap in bytes, from /proc/meminfo
+    """
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    return meminfo.get("MemAvailable", 0) + meminfo.get("SwapFree", 0)
+
+
 def _try_dd(imagefile: str, size: int, ovewrite: bool):
     if os.path.exists(imagefile) and not ovewrite:
         raise ImageFileExistsException(imagefile)
@@ -598,7 +1423,7 @@ def _try_dd(imagefile: str, size: int, ovewrite: bool):
     # TODO: Replace with a pure python zero file
     print_notice(f"Executing DD, allocating {size} bytes...")
     try:
-        subprocess.run(
+        _get_runner().run(
             [
                 "dd",
                 "if=/dev/null",
@@ -619,7 +1444,7 @@ def _try_parted(imagefile: str, parted: List[str]):
     print_notice(f"Executing parted script:")
     print_notice("\n".join(parted))
     try:
-        subprocess.run(
+        _get_runner().run(
             ["parted", "--script", imagefile, "--"] + parted + ["print"], check=True
         )
     except subprocess.CalledProcessError as err:
@@ -628,7 +1453,40 @@ def _try_parted(imagefile: str, parted: List[str]):
     print_ok("Parted succeeded.")
 
 
-def _try_mkfs(dirname: str, fstype: str):
+def _try_set_disk_ids(
+    imagefile: str, table_type: Optional[str], count: int, reproducible: Reproducible
+):
+    """
+    Replaces the random disk identifier and GPT partition GUIDs set by parted
+    """
+    if table_type == "gpt":
+        cmds = [["sfdisk", "--disk-id", imagefile, str(reproducible.get_uuid("disk"))]]
+        for i in range(1, count + 1):
+            part_uuid = str(reproducible.get_uuid("partition", str(i)))
+            cmds.append(["sfdisk", "--part-uuid", imagefile, str(i), part_uuid])
+    elif table_type == "msdos":
+        disk_id = "0x" + reproducible.get_uuid("disk").hex[:8]
+        cmds = [["sfdisk", "--disk-id", imagefile, disk_id]]
+    else:
+        print_notice(f"Unable to set disk ids for partition table '{table_type}'")
+        return
+
+    print_notice(f"Setting disk ids for {table_type} partition table...")
+    try:
+        for cmd in cmds:
+            _get_runner().run(cmd, check=True)
+    except subprocess.CalledProcessError as err:
+        print_error("Setting disk ids failed.")
+        raise err
+    print_ok("Setting disk ids succeeded.")
+
+
+def _try_mkfs(
+    dirname: str,
+    fstype: str,
+    reproducible: Optional[Reproducible] = None,
+    name: str = "",
+):
     cmds = {
         "fat32": ["mkfs.fat", "-F", "32", dirname],
         "ext4": ["mkfs.ext4", "-F", dirname],
@@ -639,14 +1497,44 @@ def _try_mkfs(dirname: str, fstype: str):
     if fstype not in cmds:
         raise UnknownFilesystemException(fstype)
 
+    cmd = cmds[fstype]
+    env = None
+    if reproducible:
+        fs_uuid = str(reproducible.get_uuid("filesystem", name))
+        hash_seed = str(reproducible.get_uuid("hash_seed", name))
+        volume_id = reproducible.get_uuid("filesystem", name).hex[:8]
+        reproducible_args = {
+            "fat32": ["-i", volume_id],
+            "ext4": ["-U", fs_uuid, "-E", f"hash_seed={hash_seed}"],
+            "ext2": ["-U", fs_uuid, "-E", f"hash_seed={hash_seed}"],
+            "linux-swap": ["-U", fs_uuid],
+        }
+        cmd = cmd[:1] + reproducible_args[fstype] + cmd[1:]
+        env = dict(
+            os.environ,
+            SOURCE_DATE_EPOCH=str(reproducible.epoch),
+            E2FSPROGS_FAKE_TIME=str(reproducible.epoch),
+        )
+
     print_notice(f"Executing mkfs {fstype} for {dirname}...")
     try:
-        subprocess.run(cmds[fstype], check=True)
+        _get_runner().run(cmd, check=True, env=env)
     except subprocess.CalledProcessError as err:
         print_error("Mkfs failed.")
         raise err
     print_ok("Mkfs succeeded.")
 
 
+def _clamp_mtimes(dirname: str, epoch: int):
+    """
+    Clamps modification times newer than the epoch to the epoch
+    """
+    for dirpath, dirnames, filenames in os.walk(dirname, topdown=False):
+        for fname in filenames + dirnames + [""]:
+            path = os.path.join(dirpath, fname) if fname else dirpath
+            if os.lstat(path).st_mtime > epoch:
+                os.utime(path, (epoch, epoch), follow_symlinks=False)
+
+
 if __name__ == "__main__":
     main()
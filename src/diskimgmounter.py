@@ -11,7 +11,16 @@ Disk Image Mounter (.img) - Mounts the partitions in the img and executes a give
 Source code: https://github.com/Ciantic/diskimgcreator
 
 """
-from diskimgcreator import Partfs, Losetup, Mount, print_error, _set_verbose
+from diskimgcreator import (
+    Partfs,
+    Losetup,
+    Mount,
+    print_error,
+    print_ok,
+    print_notice,
+    _set_verbose,
+    _get_runner,
+)
 import uuid
 from typing import List, Optional
 from contextlib import ExitStack, contextmanager
@@ -26,6 +35,62 @@ import textwrap
 import subprocess
 
 
+class SnapshotNotSupportedException(Exception):
+    def __init__(self, snapshotfile: str):
+        self.snapshotfile = snapshotfile
+
+
+class Snapshot:
+    """
+    Copy-on-write snapshot of the diskimage
+
+    Takes a reflink clone of the image before it's modified. If the block
+    exits with an error, the image is restored from the clone, otherwise the
+    clone is just removed. Both are cheap as only the changed blocks are ever
+    copied.
+
+    Reflinks require filesystem support (btrfs, xfs, ...) and the snapshot to
+    be on the same filesystem as the image. The image is restored in place, so
+    this works with bind mounted image files too.
+    """
+
+    def __init__(self, diskimage: str, snapshot_dir: Optional[str] = None):
+        self.diskimage = diskimage
+        self.snapshotfile = os.path.join(
+            snapshot_dir or os.path.dirname(os.path.abspath(diskimage)),
+            "{}.snapshot{}".format(os.path.basename(diskimage), uuid.uuid4().hex),
+        )
+
+    def __enter__(self):
+        try:
+            _get_runner().run(
+                ["cp", "--reflink=always", self.diskimage, self.snapshotfile],
+                check=True,
+            )
+        except subprocess.CalledProcessError:
+            # Failed clone may leave an empty file behind
+            if os.path.exists(self.snapshotfile):
+                os.remove(self.snapshotfile)
+            raise SnapshotNotSupportedException(self.snapshotfile)
+        print_ok(f"Snapshot {self.snapshotfile} created.")
+        return self.snapshotfile
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            print_notice(f"Restoring '{self.diskimage}' from snapshot...")
+            try:
+                _get_runner().run(
+                    ["cp", "--reflink=always", self.snapshotfile, self.diskimage],
+                    check=True,
+                )
+            except subprocess.CalledProcessError as err:
+                print_error(f"Restore failed, snapshot kept: {self.snapshotfile}")
+                raise err
+            print_ok(f"Snapshot {self.snapshotfile} restored.")
+        os.remove(self.snapshotfile)
+        print_ok(f"Snapshot {self.snapshotfile} removed.")
+
+
 @contextmanager
 def try_mount_image(
     imagefilename: str,
@@ -33,10 +98,15 @@ def try_mount_image(
     mount_root_dir="/mnt",
     use_partfs=False,
     partfs_mount_dir="/mnt/_temp_partfs",
+    snapshot=False,
+    snapshot_dir: Optional[str] = None,
 ):
     if not os.path.exists(mount_root_dir):
         os.mkdir(mount_root_dir)
     with ExitStack() as cm:
+        # Snapshot is entered first so it's restored after everything is unmounted
+        if snapshot:
+            cm.enter_context(Snapshot(imagefilename, snapshot_dir))
         if use_partfs:
             partfs = cm.enter_context(Partfs(imagefilename, partfs_mount_dir))
         else:
@@ -77,6 +147,16 @@ def parse_cli_arguments():
         help="Uses FUSE based partfs instead of losetup for mounting partitions, defaults to true in docker environment",
         action="store_true",
     )
+    parser.add_argument(
+        "--snapshot",
+        help="Restores the image if the script fails, requires reflink support (btrfs, xfs) from the filesystem",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        help="Directory for the snapshot, must be in the same filesystem as the image, defaults to the image directory",
+        action="store",
+    )
     parser.add_argument("-v", "--verbose", action="store_true")
 
     return (parser, parser.parse_args())
@@ -100,12 +180,19 @@ def main():
             use_partfs=args.use_partfs,
             mount_root_dir=mount_root_dir,
             partfs_mount_dir="/mnt/_tmp_partfs{}".format(uuid.uuid4().hex),
+            snapshot=args.snapshot,
+            snapshot_dir=args.snapshot_dir,
         ):
             try:
                 subprocess.run(args.cmd, check=True, cwd=mount_root_dir)
             except subprocess.CalledProcessError as err:
                 print_error("Execution of your script failed.")
                 raise err
+    except SnapshotNotSupportedException as err:
+        print_error(
+            f"Unable to create reflink snapshot '{err.snapshotfile}', the filesystem must support reflinks"
+        )
+        exit(1)
     except subprocess.CalledProcessError as err:
         # print_error(
         #     f"Return code: {err.returncode}, Command: {subprocess.list2cmdline(err.cmd)}"
@@ -1,12 +1,100 @@
-from diskimgcreator import try_create_image, _parse_size, _set_verbose
+from diskimgcreator import (
+    try_create_image,
+    _parse_size,
+    _set_verbose,
+    Partition,
+    ProgressReporter,
+    PartitionCollection,
+    PreflightException,
+    try_preflight,
+    Staging,
+    CommandRunner,
+    _set_runner,
+    _try_get_partitions_long_format,
+    _try_get_partitions_short_format,
+    ArchiveReader,
+)
 from diskimgmounter import try_mount_image
 import unittest
 import os
+import io
+import json
+import glob
+import gzip
+import time
+import tempfile
+import subprocess
 import datetime
 
 _set_verbose(True)
 
 
+class FakePopen:
+    def __init__(self, cmd, returncode: int, stdin=None, stdout=None):
+        self.args = cmd
+        self.returncode = returncode
+        self.stdin = io.BytesIO() if stdin == subprocess.PIPE else None
+        self.stdout = io.BytesIO() if stdout == subprocess.PIPE else None
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+
+class FakeCommandRunner(CommandRunner):
+    """
+    Records the commands and simulates them without running anything
+
+    Simulates the side effects the orchestration depends on: `dd` creates the
+    sparse image file, `partfs` creates the partition files and `losetup -f`
+    returns a free device. Commands in `fail` exit with an error.
+    """
+
+    def __init__(self, partitions: int = 0, fail=()):
+        self.partitions = partitions
+        self.fail = set(fail)
+        self.commands = []
+
+    def _simulate(self, cmd):
+        self.commands.append(cmd)
+        if cmd[0] in self.fail:
+            return 1, ""
+        if cmd[0] == "dd":
+            args = dict(arg.split("=", 1) for arg in cmd[1:])
+            with open(args["of"], "wb") as f:
+                f.truncate(int(args["seek"]))
+        elif cmd[0] == "partfs":
+            for i in range(1, self.partitions + 1):
+                open(os.path.join(cmd[-1], f"p{i}"), "w").close()
+        elif cmd[0] == "fusermount":
+            for fname in glob.glob(os.path.join(cmd[-1], "p[0-9]*")):
+                os.remove(fname)
+        elif cmd[:2] == ["losetup", "-f"]:
+            return 0, "/dev/loop0\n"
+        return 0, ""
+
+    def run(self, cmd, check=False, **kwargs):
+        returncode, stdout = self._simulate(cmd)
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return subprocess.CompletedProcess(cmd, returncode, stdout, "")
+
+    def popen(self, cmd, stdin=None, stdout=None, **kwargs):
+        returncode, _ = self._simulate(cmd)
+        return FakePopen(cmd, returncode, stdin, stdout)
+
+    def which(self, cmd):
+        return "/usr/bin/" + cmd
+
+    def get_command_names(self):
+        return [cmd[0] for cmd in self.commands]
+
+
 class TestParseSize(unittest.TestCase):
     def test_parse_size(self):
         self.assertEqual(_parse_size("5.5"), 5.5 * 1000 ** 2)
@@ -18,6 +106,210 @@ class TestParseSize(unittest.TestCase):
         self.assertEqual(_parse_size("1.75GiB"), 1024 * 1024 * 1024 * 1.75)
 
 
+class TestProgress(unittest.TestCase):
+    def test_content_size(self):
+        partition = Partition("../example03/partition02_128MiB_ext4.tar.gz", "")
+        self.assertEqual(partition.get_content_size(), 44)
+
+    def test_progress_json(self):
+        stream = io.StringIO()
+        progress = ProgressReporter(json_stream=stream)
+        progress.update("p1", 50, 100, 2.0)
+        progress.update("p1", 100, 100, 4.0, True)
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(events[0]["event"], "progress")
+        self.assertEqual(events[0]["eta"], 2.0)
+        self.assertEqual(events[1]["event"], "done")
+        self.assertEqual(events[1]["bytes_done"], 100)
+
+
+class TestReproducible(unittest.TestCase):
+    def test_reproducible_uuids(self):
+        partitions = PartitionCollection.from_directory("../example03")
+        first = partitions.get_reproducible(0)
+        second = PartitionCollection.from_directory("../example03").get_reproducible(0)
+        self.assertEqual(first.get_uuid("disk"), second.get_uuid("disk"))
+        self.assertNotEqual(first.get_uuid("disk"), first.get_uuid("partition", "1"))
+
+    def test_table_type(self):
+        partitions = PartitionCollection.from_directory("../example03")
+        self.assertEqual(partitions.get_table_type(), "msdos")
+        partitions = PartitionCollection.from_directory("../example01")
+        self.assertEqual(partitions.get_table_type(), "gpt")
+
+
+class TestPreflight(unittest.TestCase):
+    def test_partition_sizes(self):
+        partitions = PartitionCollection.from_directory("../example02")
+        total_size = partitions.get_total_size()
+        self.assertEqual(
+            partitions.get_partition_sizes(total_size),
+            [128 * 1024 ** 2 - 1000 ** 2, 128 * 1024 ** 2],
+        )
+
+    def test_files_do_not_fit(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            partition_dir = os.path.join(tempdir, "partition01_2MiB_ext4")
+            os.mkdir(partition_dir)
+            with open(os.path.join(partition_dir, "big.bin"), "wb") as f:
+                f.write(b"\0" * 2 * 1024 ** 2)
+            partitions = PartitionCollection.from_directory(tempdir)
+            with self.assertRaises(PreflightException) as cm:
+                try_preflight(
+                    partitions,
+                    os.path.join(tempdir, "image.img"),
+                    partitions.get_total_size(),
+                )
+            self.assertTrue(
+                any("Files need" in error for error in cm.exception.errors)
+            )
+
+
+class TestStaging(unittest.TestCase):
+    def test_publish(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            imagefile = os.path.join(tempdir, "image.img")
+            staging_dir = os.path.join(tempdir, "staging")
+            with Staging(imagefile, staging_dir, 0) as stagedimage:
+                with open(stagedimage, "w") as f:
+                    f.write("image")
+            self.assertEqual(os.listdir(staging_dir), [])
+            with open(imagefile) as f:
+                self.assertEqual(f.read(), "image")
+
+    def test_failed_build(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            imagefile = os.path.join(tempdir, "image.img")
+            staging_dir = os.path.join(tempdir, "staging")
+            with self.assertRaises(RuntimeError):
+                with Staging(imagefile, staging_dir, 0) as stagedimage:
+                    with open(stagedimage, "w") as f:
+                        f.write("partial")
+                    raise RuntimeError()
+            self.assertEqual(os.listdir(staging_dir), [])
+            self.assertFalse(os.path.exists(imagefile))
+
+
+class TestFakeCreateImage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.runner = FakeCommandRunner(partitions=3)
+        _set_runner(self.runner)
+
+    def tearDown(self):
+        _set_runner(CommandRunner())
+        self.tempdir.cleanup()
+
+    def _create_image(self, **kwargs):
+        try_create_image(
+            "../example03",
+            os.path.join(self.tempdir.name, "example03.img"),
+            use_partfs=True,
+            partfs_mount_dir=os.path.join(self.tempdir.name, "partfs"),
+            mount_root_dir=os.path.join(self.tempdir.name, "fs"),
+            **kwargs,
+        )
+
+    def test_create_image(self):
+        self._create_image()
+        self.assertEqual(
+            self.runner.get_command_names(),
+            ["dd", "parted", "partfs"]
+            + ["mkfs.fat", "mount", "tar", "umount"]
+            + ["mkfs.ext4", "mount", "tar", "umount"]
+            + ["mkswap", "fusermount"],
+        )
+        self.assertEqual(
+            os.path.getsize(os.path.join(self.tempdir.name, "example03.img")),
+            150 * 1024 ** 2,
+        )
+
+    def test_mkfs_failure_unmounts(self):
+        self.runner.fail = {"mkfs.ext4"}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._create_image()
+        self.assertEqual(self.runner.get_command_names()[-1], "fusermount")
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, "partfs")))
+
+    def test_reproducible(self):
+        self._create_image(reproducible_epoch=0)
+        self.assertIn("sfdisk", self.runner.get_command_names())
+        mkfs = [cmd for cmd in self.runner.commands if cmd[0] == "mkfs.ext4"][0]
+        self.assertIn("-U", mkfs)
+
+    def test_staging(self):
+        staging_dir = os.path.join(self.tempdir.name, "staging")
+        self._create_image(staging_dir=staging_dir)
+        self.assertEqual(os.listdir(staging_dir), [])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tempdir.name, "example03.img"))
+        )
+
+
+    def test_pipelined(self):
+        self._create_image(pipelined=True, readahead=1024 ** 2)
+        names = self.runner.get_command_names()
+        self.assertEqual(names[:3], ["dd", "parted", "partfs"])
+        self.assertEqual(
+            sorted(names[3:6]), sorted(["mkfs.fat", "mkfs.ext4", "mkswap"])
+        )
+        self.assertEqual(
+            names[6:], ["mount", "tar", "umount", "mount", "tar", "umount", "fusermount"]
+        )
+        self.assertIn("-", self.runner.commands[7])
+
+
+class TestArchiveReader(unittest.TestCase):
+    def test_read_gzip(self):
+        filename = "../example03/partition02_128MiB_ext4.tar.gz"
+        reader = ArchiveReader(filename, 1)
+        reader.run()
+        with gzip.open(filename) as f:
+            self.assertEqual(b"".join(reader), f.read())
+
+    def test_cancel(self):
+        reader = ArchiveReader("../example03/partition01_msdos_100MiB_fat32.tar", 1)
+        reader.cancel()
+        reader.run()
+
+
+class TestParseFilenames(unittest.TestCase):
+    count = 5000
+
+    def test_short_format(self):
+        files = [
+            f"partition{i % 100:02d}_{i + 1}MiB_ext4.tar.gz" for i in range(self.count)
+        ]
+        started = time.monotonic()
+        partitions = _try_get_partitions_short_format(files)
+        elapsed = time.monotonic() - started
+        print(f"Parsed {self.count} short format names in {elapsed:.3f}s")
+        self.assertEqual(len(partitions), self.count)
+        self.assertEqual(partitions[1].start, "1MiB")
+        self.assertEqual(partitions[-1].end, "100%")
+
+    def test_long_format(self):
+        files = [
+            f"partition{i % 100:02d} -- parted mkpart primary ext4 {i}MiB {i + 1}MiB"
+            for i in range(self.count)
+        ]
+        started = time.monotonic()
+        partitions = _try_get_partitions_long_format(files)
+        elapsed = time.monotonic() - started
+        print(f"Parsed {self.count} long format names in {elapsed:.3f}s")
+        self.assertEqual(len(partitions), self.count)
+        self.assertEqual(partitions[-1].end, f"{self.count}MiB")
+
+    def test_parse_size(self):
+        units = ["", "KiB", "GB"]
+        sizes = [f"{i}.5{unit}" for i in range(self.count) for unit in units]
+        started = time.monotonic()
+        total = sum(_parse_size(size) for size in sizes)
+        elapsed = time.monotonic() - started
+        print(f"Parsed {len(sizes)} sizes in {elapsed:.3f}s")
+        self.assertGreater(total, 0)
+
+
 class TestCreateImage(unittest.TestCase):
     def test_create_image(self):
         try_create_image(